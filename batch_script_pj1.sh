@@ -11,6 +11,6 @@
 
 module purge all
 
-module load jq
+module load aria2
 
 uv run process_pipeline.py redpajama-data-1t
\ No newline at end of file
@@ -9,6 +9,7 @@ dolma = DatasetConfig(
             selection_sql="metadata.url",
             inclusion_filters=["c4-", "cc_"],
             exclusion_filters=None,
+            json_schema={"metadata": "STRUCT(url VARCHAR)"},
         ),
         VariantConfig(
             name="v1.6",
@@ -16,6 +17,7 @@ dolma = DatasetConfig(
             selection_sql="metadata.url",
             inclusion_filters=["c4-", "cc_"],
             exclusion_filters=None,
+            json_schema={"metadata": "STRUCT(url VARCHAR)"},
         ),
         VariantConfig(
             name="v1.7",
@@ -23,6 +25,7 @@ dolma = DatasetConfig(
             selection_sql="metadata.url",
             inclusion_filters=["c4-", "cc_", "falcon-refinedweb"],
             exclusion_filters=None,
+            json_schema={"metadata": "STRUCT(url VARCHAR)"},
         ),
     ],
     fpath_suffix=".json.gz",
@@ -37,6 +40,7 @@ redpajama_1t = DatasetConfig(
             selection_sql="meta.url",
             inclusion_filters=["c4-train"],
             exclusion_filters=None,
+            json_schema={"meta": "STRUCT(url VARCHAR)"},
         )
     ],
     fpath_suffix=".jsonl"
@@ -51,6 +55,7 @@ redpajama_v2 = DatasetConfig(
             selection_sql="url",
             inclusion_filters=[".json.gz"],
             exclusion_filters=None,
+            json_schema={"url": "VARCHAR"},
         )
     ],
     fpath_suffix=".json.gz"
@@ -65,6 +70,7 @@ hpltv1_2 = DatasetConfig(
             selection_sql="url",
             inclusion_filters=[".jsonl.zst"],
             exclusion_filters=None,
+            json_schema={"url": "VARCHAR"},
         )
     ],
     fpath_suffix=".jsonl.zst",
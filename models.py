@@ -1,17 +1,21 @@
-from typing import List, Optional
+from dataclasses import dataclass
+from typing import Dict, List, Optional
 
-from pydantic import BaseModel
 
-
-class VariantConfig(BaseModel):
+@dataclass(frozen=True, slots=True)
+class VariantConfig:
     name: str
     url_list_url: str
     selection_sql: str
     inclusion_filters: List[str]
     exclusion_filters: Optional[List[str]] = None
+    # Column name -> DuckDB type; lets read_json skip schema sniffing and
+    # decode only the listed fields
+    json_schema: Optional[Dict[str, str]] = None
 
 
-class DatasetConfig(BaseModel):
+@dataclass(frozen=True, slots=True)
+class DatasetConfig:
     name: str
     variants: List[VariantConfig]
     fpath_suffix: str
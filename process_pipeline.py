@@ -1,18 +1,28 @@
 import argparse
+import gzip
 import hashlib
-import json
 import logging
 import os
+import re
+import shutil
 import subprocess
 import tempfile
 import time
-from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, Union
 
+# Parallel Rust uploader for the large parquet pushes; must be set before
+# huggingface_hub is imported
+os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+
 import duckdb
-import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import tldextract
+import zstandard
 from huggingface_hub import HfApi
 from tqdm import tqdm
 
@@ -25,15 +35,72 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+# Shared extractor built once per process from the bundled suffix snapshot;
+# avoids rebuilding the suffix trie (and fetching the live list) in every worker
+_tld_extract = tldextract.TLDExtract(
+    suffix_list_urls=(), fallback_to_snapshot=True, cache_dir=None
+)
+
+
 def extract_domain(url: str) -> Union[str, None]:
+    # tldextract never raises on string input, so no exception guard is
+    # needed; None covers hosts the regex in extract_domain_batch missed
     if url is None:
         return None
-    try:
-        extracted = tldextract.extract(url)
-        # Return the full domain information as a formatted string
-        return f"{extracted.domain}.{extracted.suffix}"
-    except Exception:
-        return None  # Handle potential errors in tldextract
+    extracted = _tld_extract(url)
+    return f"{extracted.domain}.{extracted.suffix}"
+
+
+def extract_domain_batch(urls: pa.ChunkedArray) -> pa.Array:
+    """Arrow-batched version of extract_domain for the DuckDB UDF.
+
+    Host isolation and the fan-out back to rows run in Arrow C kernels;
+    Python (and the suffix-list lookup) only ever sees each unique host
+    once per chunk, which is a small fraction of the rows for crawl data.
+    """
+    if isinstance(urls, pa.ChunkedArray):
+        urls = urls.combine_chunks()
+    # Pull the host out of the URL: optional scheme, optional userinfo up
+    # to an @, then everything up to the first of / : ? #
+    hosts = pc.struct_field(
+        pc.extract_regex(
+            urls,
+            r"^(?:[a-zA-Z][a-zA-Z0-9+.-]*://)?(?:[^/?#]*@)?(?P<host>[^/:?#@]+)",
+        ),
+        "host",
+    )
+    encoded = pc.dictionary_encode(hosts)
+    unique_domains = pa.array(
+        [extract_domain(host) for host in encoded.dictionary.to_pylist()],
+        type=pa.string(),
+    )
+    return pc.take(unique_domains, encoded.indices)
+
+
+def get_connection() -> duckdb.DuckDBPyConnection:
+    """In-memory DuckDB connection with the extract_domain UDF registered."""
+    con = duckdb.connect(":memory:")
+    # Leave headroom under the 64G Slurm allocation (8 CPUs x 8G) for the
+    # Python process — and tmpfs staging if opted into — with overflow
+    # spilling to disk instead of erroring out
+    con.execute("SET memory_limit='48GB'")
+    spill_dir = os.path.join(os.environ.get("SLURM_TMPDIR", "/tmp"), "duckdb_spill")
+    con.execute(f"SET temp_directory='{spill_dir}'")
+    # Match the Slurm allocation if running under Slurm; otherwise DuckDB
+    # defaults to all visible cores
+    n_threads = os.environ.get("SLURM_CPUS_ON_NODE")
+    if n_threads:
+        con.execute(f"SET threads TO {n_threads}")
+    # Arrow-typed UDF: DuckDB hands over whole column chunks instead of
+    # crossing the C<->Python boundary once per row
+    con.create_function(
+        "extract_domain",
+        extract_domain_batch,
+        ["VARCHAR"],
+        "VARCHAR",
+        type="arrow",
+    )
+    return con
 
 
 def batch_urls(url_list, batch_size=100):
@@ -67,37 +134,23 @@ def create_url_mapping(
     return url_mapping
 
 
-def save_url_mapping(url_mapping: Dict[str, str], mapping_file: Path):
-    """Save URL mapping to a JSON file."""
-    with open(mapping_file, "w") as f:
-        json.dump(url_mapping, f, indent=2)
-
-
-def load_url_mapping(mapping_file: Path) -> Dict[str, str]:
-    """Load URL mapping from a JSON file."""
-    if mapping_file.exists():
-        with open(mapping_file, "r") as f:
-            return json.load(f)
-    return {}
-
-
 def is_xml_file(file_path: Path) -> bool:
     """Check if a file contains XML content by examining the first few bytes."""
     try:
-        if file_path.suffix in [".gz", ".zst"]:
-            # For compressed files, use zstdcat to read the first few bytes
-            command = f"zstdcat {file_path} | head -c 100"
+        if file_path.suffix == ".gz":
+            with gzip.open(file_path, "rb") as f:
+                head = f.read(200)
+        elif file_path.suffix == ".zst":
+            with open(file_path, "rb") as raw:
+                head = zstandard.ZstdDecompressor().stream_reader(raw).read(200)
         else:
-            # For uncompressed files, read directly
-            command = f"head -c 100 {file_path}"
-
-        result = subprocess.run(command, shell=True, capture_output=True, text=True)
-        if result.returncode == 0:
-            content = result.stdout.strip()
-            # Check for XML markers
-            return (
-                content.startswith("<?xml") or "<SelectObjectContentRequest" in content
-            )
+            with open(file_path, "rb") as f:
+                head = f.read(200)
+        # Check for XML markers
+        return (
+            head.lstrip().startswith(b"<?xml")
+            or b"<SelectObjectContentRequest" in head
+        )
     except Exception:
         pass
     return False
@@ -115,13 +168,24 @@ def redownload_corrupted_file(
             os.unlink(file_path)
             logger.info(f"Removed corrupted file: {file_path}")
 
-        # Re-download the file
+        # Re-download the file; argument list, no shell
+        cmd = [
+            "wget",
+            "-q",
+            f"--directory-prefix={str(downloads_path)}",
+            "--continue",
+            "--no-clobber",
+            "--tries=10",
+            "--no-check-certificate",
+        ]
         if dataset_name == "redpajama-data-v2":
-            cmd = f"wget -q --directory-prefix={str(downloads_path)} --continue --no-clobber --tries=10 --cut-dirs 1 --force-directories --no-check-certificate -nH {url}"
-        else:
-            cmd = f"wget -q --directory-prefix={str(downloads_path)} --continue --no-clobber --tries=10 --no-check-certificate {url}"
+            cmd += ["--cut-dirs=1", "--force-directories", "-nH"]
+        cmd.append(url)
 
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
+        # Only stderr is ever inspected; don't buffer stdout in memory
+        result = subprocess.run(
+            cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+        )
 
         if result.returncode == 0:
             logger.info(f"Successfully re-downloaded: {file_path}")
@@ -135,82 +199,390 @@ def redownload_corrupted_file(
         return False
 
 
-def process_url_file_with_retry(args):
-    """Process a file with retry logic for corrupted files."""
-    fpath, selector, url_mapping, downloads_path, dataset_name = args
+def extract_batch_to_parquet(
+    json_files: list,
+    variant,
+    parquet_file: Path,
+    url_mapping: Dict[str, str],
+    batch_downloads_path: Path,
+    dataset_name: str,
+):
+    """Extract URLs/domains from all files in a batch with one DuckDB query.
+
+    Corrupted files — unreadable streams and truncated or garbage records
+    alike — surface as query errors that name the offending file; those
+    are re-downloaded and the query retried.
+    """
+    con = get_connection()
+    selector = variant.selection_sql
+    files_sql = ", ".join(f"'{f}'" for f in json_files)
+    if variant.json_schema:
+        # Known schema: no sniffing pass over the files, and only the
+        # selected field gets decoded per record
+        columns_sql = ", ".join(
+            f"{name}: '{dtype}'" for name, dtype in variant.json_schema.items()
+        )
+        reader_sql = f"read_json([{files_sql}], columns={{{columns_sql}}}"
+    else:
+        reader_sql = f"read_json_auto([{files_sql}]"
 
     max_retries = 2
-    for attempt in range(max_retries + 1):
-        try:
-            return process_url_file((fpath, selector))
-        except Exception as e:
-            error_msg = str(e)
-
-            # Check if this is a corruption-related error
-            is_corruption_error = any(
-                phrase in error_msg.lower()
-                for phrase in [
-                    "parse error",
-                    "invalid",
-                    "unexpected",
-                    "corrupt",
-                    "malformed",
-                    "numeric literal",
-                ]
-            )
-
-            if is_corruption_error and attempt < max_retries:
-                logger.warning(
-                    f"Detected corrupted file {fpath} (attempt {attempt + 1}/{max_retries + 1}): {error_msg}"
+    try:
+        for attempt in range(max_retries + 1):
+            try:
+                con.execute(
+                    f"""
+                    COPY (
+                        SELECT {selector} AS url, extract_domain({selector}) AS domain
+                        FROM {reader_sql},
+                            format='newline_delimited',
+                            compression='auto_detect'
+                        )
+                        WHERE url IS NOT NULL AND url != '' AND domain IS NOT NULL
+                    ) TO '{parquet_file}' (
+                        FORMAT PARQUET,
+                        CODEC 'ZSTD',
+                        COMPRESSION_LEVEL 3,
+                        ROW_GROUP_SIZE 1000000
+                    )
+                    """
+                )
+                return
+            except Exception as e:
+                error_msg = str(e)
+
+                # Check if this is a corruption-related error
+                is_corruption_error = any(
+                    phrase in error_msg.lower()
+                    for phrase in [
+                        "parse error",
+                        "invalid",
+                        "unexpected",
+                        "corrupt",
+                        "malformed",
+                        "numeric literal",
+                        "not a gzip stream",
+                        "truncated",
+                    ]
                 )
 
-                # Try to re-download the file
-                file_path_str = str(fpath)
-                if file_path_str in url_mapping:
-                    url = url_mapping[file_path_str]
-                    if redownload_corrupted_file(
-                        file_path_str, url, downloads_path, dataset_name
-                    ):
-                        logger.info(
-                            f"Re-download successful, retrying processing of {fpath}"
-                        )
+                if is_corruption_error and attempt < max_retries:
+                    # DuckDB names the file it choked on in an `in file "..."`
+                    # clause; match only there, not against the echoed query
+                    # text (the LINE N: context lists every file in the batch)
+                    batch_files = {str(f) for f in json_files}
+                    corrupted = [
+                        f
+                        for f in re.findall(r'in file "([^"]+)"', error_msg)
+                        if f in batch_files
+                    ]
+                    if not corrupted:
+                        head = re.split(r"\nLINE \d+:", error_msg)[0]
+                        corrupted = [f for f in batch_files if f in head]
+                    logger.warning(
+                        f"Detected corrupted file(s) {corrupted} (attempt {attempt + 1}/{max_retries + 1}): {error_msg}"
+                    )
+
+                    redownloaded = False
+                    for file_path_str in corrupted:
+                        if file_path_str in url_mapping:
+                            url = url_mapping[file_path_str]
+                            if redownload_corrupted_file(
+                                file_path_str, url, batch_downloads_path, dataset_name
+                            ):
+                                redownloaded = True
+                            else:
+                                logger.error(f"Re-download failed for {file_path_str}")
+                        else:
+                            logger.error(
+                                f"No URL mapping found for corrupted file: {file_path_str}"
+                            )
+
+                    if redownloaded:
+                        logger.info("Re-download successful, retrying extraction")
                         continue
-                    else:
-                        logger.error(f"Re-download failed for {fpath}")
-                else:
-                    logger.error(f"No URL mapping found for corrupted file: {fpath}")
 
-            # If it's the last attempt or not a corruption error, re-raise
-            if attempt == max_retries:
+                # If it's the last attempt or not a corruption error, re-raise
                 logger.error(
-                    f"Failed to process file {fpath} after {max_retries + 1} attempts: {error_msg}"
+                    f"Failed to extract batch after {attempt + 1} attempts: {error_msg}"
                 )
                 raise e
+    finally:
+        con.close()
 
 
-def process_url_file(args):
-    fpath, selector = args
-    if fpath.suffix == ".gz":
-        command = f"gunzip -c {fpath} | jq -r '.{selector}'"
-    elif fpath.suffix == ".zst":
-        command = f"zstdcat {fpath} | jq -r '.{selector}'"
-    else:
-        command = f"cat {fpath} | jq -r '.{selector}'"
-    result = subprocess.run(command, shell=True, capture_output=True, text=True)
-    if result.returncode != 0:
-        raise Exception(f"Failed to process file {fpath}: {result.stderr}")
-    extracted_urls = result.stdout.splitlines()
-    domains = [extract_domain(url) for url in extracted_urls]
-
-    df = pd.DataFrame({"url": extracted_urls, "domain": domains})
-    df = df.dropna()
-    df.to_parquet(
-        fpath.with_suffix(".parquet"),
-        index=False,
-        compression="zstd",
-        engine="pyarrow",
+def url_digest(url: str) -> int:
+    """Stable 8-byte digest of a URL, used for the completed-URL log."""
+    return int.from_bytes(
+        hashlib.blake2b(url.encode(), digest_size=8).digest(), "little"
     )
-    return True
+
+
+def completed_log_path(pattern_local: str) -> Path:
+    """Path of the binary completed-URL digest log for a variant."""
+    return (Path("completed") / pattern_local).with_suffix(".bin")
+
+
+def load_completed_digests(pattern_local: str) -> np.ndarray:
+    """Load the completed-URL digest log, migrating the legacy text log."""
+    bin_path = completed_log_path(pattern_local)
+    txt_path = Path("completed") / pattern_local
+    if not bin_path.exists() and txt_path.exists():
+        # One-time migration from the line-oriented log: 8 bytes per URL
+        # instead of the full URL string
+        logger.info(f"Migrating {txt_path} to digest log {bin_path}")
+        with open(txt_path, "r") as f:
+            urls = [line.strip() for line in f if line.strip()]
+        with open(bin_path, "wb") as f:
+            for url in urls:
+                f.write(url_digest(url).to_bytes(8, "little"))
+    if bin_path.exists():
+        return np.fromfile(bin_path, dtype="<u8")
+    return np.empty(0, dtype="<u8")
+
+
+def append_completed(pattern_local: str, urls: list):
+    """Append URL digests to the binary completed log in one write."""
+    payload = b"".join(url_digest(url).to_bytes(8, "little") for url in urls)
+    with open(completed_log_path(pattern_local), "ab") as f:
+        f.write(payload)
+
+
+def get_batch_hash(url_batch: list) -> str:
+    """Short stable identifier for a batch of URLs."""
+    # Feed the hasher incrementally instead of materializing one joined
+    # string (several MB for the 10k-URL redpajama batches)
+    h = hashlib.blake2b(digest_size=4)
+    for url in url_batch:
+        h.update(url.encode())
+        h.update(b"\n")
+    return h.hexdigest()
+
+
+def download_batch(
+    url_batch: list, batch_downloads_path: Path, dataset_name: str
+) -> Dict[str, str]:
+    """Download one batch of URLs into its own directory.
+
+    Returns the local-path -> source-URL mapping for the batch.
+    """
+    batch_downloads_path.mkdir(parents=True, exist_ok=True)
+    temp_file_path = None
+    try:
+        logger.info("Writing URLs to temporary file for batch download...")
+        # Create an aria2c input file for the batch of URLs
+        with tempfile.NamedTemporaryFile(mode="w", delete=False) as temp_file:
+            for url in url_batch:
+                temp_file.write(f"{url}\n")
+                if dataset_name == "redpajama-data-v2":
+                    # Preserve the wget --cut-dirs 1 --force-directories
+                    # layout: keep everything past the first directory
+                    relative_path = "/".join(url.split("/")[4:])
+                    temp_file.write(f"  out={relative_path}\n")
+            temp_file_path = temp_file.name
+
+        # Create URL mapping before downloading; it only lives in memory and
+        # is re-derived on restart, so there is nothing to persist
+        url_mapping = create_url_mapping(url_batch, batch_downloads_path, dataset_name)
+        logger.info(f"Created URL mapping with {len(url_mapping)} entries")
+
+        # Download the whole batch with one aria2c process: connection
+        # reuse + segmented downloads instead of one wget fork per URL
+        max_download_retries = 3
+        download_success = False
+
+        if dataset_name == "redpajama-data-v2":
+            n_concurrent = 4
+        else:
+            n_concurrent = 16
+
+        cmd = [
+            "aria2c",
+            f"--input-file={temp_file_path}",
+            f"--dir={str(batch_downloads_path)}",
+            "-j",
+            str(n_concurrent),
+            "-x",
+            "8",
+            "-s",
+            "8",
+            "--continue",
+            "--max-tries=10",
+            "--auto-file-renaming=false",
+            "--allow-overwrite=false",
+            "--file-allocation=none",
+            "--check-certificate=false",
+            "--quiet",
+        ]
+
+        for retry_attempt in range(max_download_retries):
+            try:
+                logger.info(
+                    f"Running download command (attempt {retry_attempt + 1}/{max_download_retries}): {' '.join(cmd)}"
+                )
+                result = subprocess.run(
+                    cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+                )
+
+                if result.returncode == 0:
+                    download_success = True
+                    break
+                else:
+                    logger.error(
+                        f"Download command failed with exit code {result.returncode}: {result.stderr}"
+                    )
+                    if retry_attempt < max_download_retries - 1:
+                        sleep_time = 60 * (2 ** retry_attempt)
+                        logger.info(f"Retrying batch download in {sleep_time} seconds...")
+                        time.sleep(sleep_time)
+                        continue
+            except subprocess.CalledProcessError as e:
+                logger.error(f"Download attempt {retry_attempt + 1} failed: {e}")
+                if retry_attempt < max_download_retries - 1:
+                    sleep_time = 60 * (2 ** retry_attempt)
+                    logger.info(f"Retrying batch download in {sleep_time} seconds...")
+                    time.sleep(sleep_time)
+                    continue
+
+        if not download_success:
+            logger.error(
+                f"Failed to download batch after {max_download_retries} attempts"
+            )
+            raise subprocess.CalledProcessError(
+                1, cmd, "Download failed after all retries"
+            )
+
+        # Remove the temporary file after use
+        os.unlink(temp_file_path)
+    except subprocess.CalledProcessError as e:
+        print(f"Failed to download batch: {e}")
+        if temp_file_path and os.path.exists(temp_file_path):
+            os.unlink(temp_file_path)
+        raise
+
+    return url_mapping
+
+
+def process_batch(
+    url_batch: list,
+    url_mapping: Dict[str, str],
+    batch_downloads_path: Path,
+    dataset,
+    variant,
+    dataset_name: str,
+    intermediate_path: Path,
+    pattern_local: str,
+) -> Path:
+    """Extract URLs and domains from a downloaded batch into one combined parquet."""
+    # The download stage already knows every path it wrote, so no directory
+    # walk is needed; just drop anything that failed to download
+    logger.info("Collecting downloaded files, filtering out XML metadata files...")
+    files = [
+        Path(path)
+        for path in url_mapping
+        if path.endswith(dataset.fpath_suffix) and os.path.exists(path)
+    ]
+
+    # Sniff file heads from a thread pool: the check is a tiny read per
+    # file, so threads overlap the I/O without any pickling overhead
+    with ThreadPoolExecutor(max_workers=8) as sniff_pool:
+        xml_flags = list(sniff_pool.map(is_xml_file, files))
+    json_files = [file for file, is_xml in zip(files, xml_flags) if not is_xml]
+
+    n_xml = len(files) - len(json_files)
+    if n_xml:
+        logger.info(f"Skipping {n_xml} XML metadata files")
+
+    logger.info(f"Extracting {len(json_files)} JSON files in one DuckDB query...")
+    parquet_file = intermediate_path / (
+        f"{pattern_local.replace('.', '_')}_{get_batch_hash(url_batch)}.parquet"
+    )
+    extract_batch_to_parquet(
+        json_files,
+        variant,
+        parquet_file,
+        url_mapping,
+        batch_downloads_path,
+        dataset_name,
+    )
+    logger.info(f"Combined parquet file created at {parquet_file}")
+    return parquet_file
+
+
+def cleanup_batch(batch_downloads_path: Path):
+    """Remove a batch's download directory in one traversal."""
+    shutil.rmtree(batch_downloads_path, ignore_errors=True)
+
+
+def coalesce_pending(pending_dir: Path, pattern_local: str):
+    """Merge the group's per-batch parquets into one file before upload.
+
+    Row groups are copied across one at a time, so memory stays bounded by
+    a single row group. Fewer, larger files keep the Hub repo's file count
+    down and give downstream scans full-size row groups.
+    """
+    parts = sorted(pending_dir.glob("*.parquet"))
+    if len(parts) <= 1:
+        return
+    digest = hashlib.blake2b(digest_size=4)
+    for part in parts:
+        digest.update(part.name.encode())
+        digest.update(b"\n")
+    merged = (
+        pending_dir / f"{pattern_local.replace('.', '_')}_{digest.hexdigest()}.parquet"
+    )
+    writer = None
+    try:
+        for part in parts:
+            reader = pq.ParquetFile(part)
+            if writer is None:
+                writer = pq.ParquetWriter(
+                    merged, reader.schema_arrow, compression="zstd", compression_level=3
+                )
+            for i in range(reader.num_row_groups):
+                writer.write_table(reader.read_row_group(i))
+            reader.close()
+    finally:
+        if writer is not None:
+            writer.close()
+    for part in parts:
+        part.unlink()
+
+
+def upload_pending(
+    pending_dir: Path,
+    pending_urls: list,
+    repo_id: str,
+    pattern_local: str,
+):
+    """Upload all accumulated batch parquets in a single Hugging Face commit."""
+    n_files = len(list(pending_dir.glob("*.parquet")))
+    coalesce_pending(pending_dir, pattern_local)
+    logger.info(f"Uploading {n_files} batch parquets from {pending_dir} to {repo_id}...")
+    api = HfApi()
+    api.create_repo(
+        repo_id=repo_id,
+        exist_ok=True,
+        repo_type="dataset",
+    )
+    api.upload_folder(
+        folder_path=pending_dir,
+        path_in_repo="",
+        repo_id=repo_id,
+        repo_type="dataset",
+        commit_message=f"Add {n_files} batches of {pattern_local}",
+        revision="main",
+    )
+
+    # Mark URLs complete only once the upload has landed
+    append_completed(pattern_local, pending_urls)
+    print(f"Added {len(pending_urls)} URLs to completed list.")
+
+    # Remove the uploaded parquets
+    for file in pending_dir.glob("*.parquet"):
+        file.unlink(missing_ok=True)
+    pending_dir.rmdir()
+    print(f"Removed uploaded batch parquets for {pattern_local}.")
 
 
 def main():
@@ -223,10 +595,23 @@ def main():
     )
     args = parser.parse_args()
 
-    intermediate_path = Path(f"/scratch/nrh146/intermediate/{args.dataset_name}")
+    # Keep the many-small-file stages (downloads, per-batch work) on
+    # node-local storage when Slurm provides it; otherwise fall back to
+    # shared scratch — two in-flight batches of downloads do not fit in a
+    # RAM-backed tmpfs within the job's memory allocation, so /dev/shm is
+    # opt-in via STAGING_DIR only. The combined parquet is staged back to
+    # shared scratch before upload either way
+    node_local_root = Path(
+        os.environ.get("STAGING_DIR")
+        or os.environ.get("SLURM_TMPDIR")
+        or "/scratch/nrh146"
+    )
+    intermediate_path = node_local_root / "intermediate" / args.dataset_name
     intermediate_path.mkdir(parents=True, exist_ok=True)
-    downloads_path = Path(f"/scratch/nrh146/downloads/{args.dataset_name}")
+    downloads_path = node_local_root / "downloads" / args.dataset_name
     downloads_path.mkdir(parents=True, exist_ok=True)
+    scratch_path = Path(f"/scratch/nrh146/intermediate/{args.dataset_name}")
+    scratch_path.mkdir(parents=True, exist_ok=True)
 
     # Find the requested dataset in the DATASETS list
     selected_dataset = None
@@ -256,17 +641,20 @@ def main():
         url_list = [url.strip() for url in url_list]
         logger.info(f"Loaded {len(url_list):,} URLs")
 
-        logger.info(f"Loading completed URLs from completed/{pattern_local}")
-        with open(f"completed/{pattern_local}", "r") as f:
-            completed = f.readlines()
-        completed_set = {url.strip() for url in completed}
-        logger.info(f"Loaded {len(completed_set):,} completed URLs")
+        logger.info(f"Loading completed URL digests for {pattern_local}")
+        completed_digests = load_completed_digests(pattern_local)
+        logger.info(f"Loaded {len(completed_digests):,} completed URL digests")
 
-        # Filter out URLs that are already completed using set for O(1) lookup
+        # Filter out already completed URLs with a vectorized digest set
+        # difference instead of a Python set probe per URL
         logger.info("Filtering out already completed URLs...")
-        url_list = [url for url in url_list if url not in completed_set]
+        url_hashes = np.fromiter(
+            (url_digest(url) for url in url_list), dtype="<u8", count=len(url_list)
+        )
+        keep_mask = ~np.isin(url_hashes, completed_digests)
+        url_list = [url for url, keep in zip(url_list, keep_mask) if keep]
         logger.info(
-            f"Found {len(url_list):,} new URLs to process (filtered out {len(completed_set):,} completed URLs)"
+            f"Found {len(url_list):,} new URLs to process (filtered out {len(completed_digests):,} completed URLs)"
         )
 
         if not url_list:
@@ -279,194 +667,84 @@ def main():
         else:
             batch_size = 100
 
-        for url_batch in tqdm(
-            list(batch_urls(url_list, batch_size=batch_size)),
-            desc=f"Processing batches for {pattern_local}",
-        ):
-            # Download the files in batch using xargs for parallel processing
-            temp_file_path = None
-            try:
-                logger.info("Writing URLs to temporary file for batch download...")
-                # Create a temporary file for the batch of URLs
-                with tempfile.NamedTemporaryFile(mode="w", delete=False) as temp_file:
-                    for url in url_batch:
-                        temp_file.write(f"{url}\n")
-                    temp_file_path = temp_file.name
-
-                # Create URL mapping before downloading
-                url_mapping = create_url_mapping(
-                    url_batch, downloads_path, args.dataset_name
-                )
-                batch_hash_temp = hashlib.md5("_".join(url_batch).encode()).hexdigest()[
-                    :8
-                ]
-                mapping_file = downloads_path / f"url_mapping_{batch_hash_temp}.json"
-                save_url_mapping(url_mapping, mapping_file)
-                logger.info(f"Created URL mapping with {len(url_mapping)} entries")
-
-                # Use xargs to run wget in parallel with retry logic
-                max_download_retries = 3
-                download_success = False
-
-                if args.dataset_name == "redpajama-data-v2":
-                    cmd = f"cat {temp_file_path} | xargs -P 2 -I {{}} wget -q --directory-prefix={str(downloads_path)} --continue --no-clobber --tries=10 --cut-dirs 1 --force-directories --no-check-certificate -nH {{}}"
-                else:
-                    cmd = f"cat {temp_file_path} | xargs -P 8 -I {{}} wget -q --directory-prefix={str(downloads_path)} --continue --no-clobber --tries=10 --no-check-certificate {{}}"
-
-                for retry_attempt in range(max_download_retries):
-                    try:
-                        logger.info(
-                            f"Running download command (attempt {retry_attempt + 1}/{max_download_retries}): {cmd}"
-                        )
-                        result = subprocess.run(
-                            cmd, shell=True, capture_output=True, text=True
-                        )
-
-                        if result.returncode == 0:
-                            download_success = True
-                            break
-                        elif result.returncode == 123:
-                            logger.warning(
-                                f"Some wget downloads failed (exit code 123) on attempt {retry_attempt + 1}/{max_download_retries}"
-                            )
-                            if retry_attempt < max_download_retries - 1:
-                                sleep_time = 60 * (2 ** retry_attempt)
-                                logger.info(f"Retrying batch download in {sleep_time} seconds...")
-                                time.sleep(sleep_time)
-                                continue
-                        else:
-                            logger.error(
-                                f"Download command failed with exit code {result.returncode}: {result.stderr}"
-                            )
-                            if retry_attempt < max_download_retries - 1:
-                                sleep_time = 60 * (2 ** retry_attempt)
-                                logger.info(f"Retrying batch download in {sleep_time} seconds...")
-                                time.sleep(sleep_time)
-                                continue
-                    except subprocess.CalledProcessError as e:
-                        logger.error(
-                            f"Download attempt {retry_attempt + 1} failed: {e}"
-                        )
-                        if retry_attempt < max_download_retries - 1:
-                            sleep_time = 60 * (2 ** retry_attempt)
-                            logger.info(f"Retrying batch download in {sleep_time} seconds...")
-                            time.sleep(sleep_time)
-                            continue
-
-                if not download_success:
-                    logger.error(
-                        f"Failed to download batch after {max_download_retries} attempts"
-                    )
-                    raise subprocess.CalledProcessError(
-                        1, cmd, "Download failed after all retries"
-                    )
-
-                # Remove the temporary file after use
-                os.unlink(temp_file_path)
-            except subprocess.CalledProcessError as e:
-                print(f"Failed to download batch: {e}")
-                if temp_file_path and os.path.exists(temp_file_path):
-                    os.unlink(temp_file_path)
-                raise
-
-            con = duckdb.connect()
-
-            files = list(Path(downloads_path).glob(f"**/*{dataset.fpath_suffix}"))
-
-            # Filter out XML metadata files
-            logger.info(
-                f"Found {len(files)} files, filtering out XML metadata files..."
+        batches = list(batch_urls(url_list, batch_size=batch_size))
+
+        # Accumulate this many batches locally before pushing one HF commit
+        upload_every = 8
+
+        # Pipeline the batches: while batch N is being processed, batch N+1 is
+        # downloading and earlier batches are uploading, so the network stages
+        # overlap the CPU-bound extraction instead of serializing with it
+        with ThreadPoolExecutor(max_workers=1) as download_executor, ThreadPoolExecutor(
+            max_workers=1
+        ) as upload_executor:
+            next_download = download_executor.submit(
+                download_batch,
+                batches[0],
+                downloads_path / f"batch_{get_batch_hash(batches[0])}",
+                args.dataset_name,
             )
-            json_files = []
-            xml_files = []
-            for file in files:
-                if is_xml_file(file):
-                    xml_files.append(file)
-                else:
-                    json_files.append(file)
-
-            if xml_files:
-                logger.info(f"Skipping {len(xml_files)} XML metadata files")
+            upload_future = None
+            pending_group = 0
+            pending_dir = scratch_path / f"pending_{variant.name}_{pending_group}"
+            pending_dir.mkdir(parents=True, exist_ok=True)
+            pending_urls = []
+
+            for i, url_batch in enumerate(
+                tqdm(batches, desc=f"Processing batches for {pattern_local}")
+            ):
+                batch_hash = get_batch_hash(url_batch)
+                batch_downloads_path = downloads_path / f"batch_{batch_hash}"
+
+                url_mapping = next_download.result()
+                if i + 1 < len(batches):
+                    next_download = download_executor.submit(
+                        download_batch,
+                        batches[i + 1],
+                        downloads_path / f"batch_{get_batch_hash(batches[i + 1])}",
+                        args.dataset_name,
+                    )
 
-            # process JSON files in parallel with retry logic
-            with Pool(processes=8) as pool:
-                logger.info(
-                    f"Processing {len(json_files)} JSON files in parallel with corruption retry..."
+                parquet_file = process_batch(
+                    url_batch,
+                    url_mapping,
+                    batch_downloads_path,
+                    dataset,
+                    variant,
+                    args.dataset_name,
+                    intermediate_path,
+                    pattern_local,
                 )
-                list(
-                    tqdm(
-                        pool.imap(
-                            process_url_file_with_retry,
-                            [
-                                (
-                                    file,
-                                    variant.selection_sql,
-                                    url_mapping,
-                                    downloads_path,
-                                    args.dataset_name,
-                                )
-                                for file in json_files
-                            ],
-                        ),
-                        total=len(json_files),
-                        desc="Processing files",
+                # Stage the combined parquet to shared scratch so it survives
+                # node-local cleanup while the upload lags behind
+                shutil.move(str(parquet_file), pending_dir / parquet_file.name)
+                pending_urls.extend(url_batch)
+                cleanup_batch(batch_downloads_path)
+
+                # Flush accumulated parquets as one HF commit every
+                # upload_every batches (and at end of variant)
+                if (i + 1) % upload_every == 0 or i + 1 == len(batches):
+                    if upload_future is not None:
+                        upload_future.result()
+                    upload_future = upload_executor.submit(
+                        upload_pending,
+                        pending_dir,
+                        pending_urls,
+                        pattern_hf,
+                        pattern_local,
                     )
-                )
-
-            parquet_file = (
-                intermediate_path / f"{pattern_local.replace('.', '_')}.parquet"
-            )
-            con.execute(
-                f"COPY (SELECT * FROM read_parquet('{str(downloads_path)}/**/*.parquet')) TO '{str(parquet_file)}';"
-            )
-            logger.info(f"Combined parquet file created at {parquet_file}")
-            # # Upload to Hugging Face
-            logger.info(f"Uploading {parquet_file} to Hugging Face...")
-            api = HfApi()
-            repo_id_to_upload = pattern_hf
-            # unique batch number for repo
-            batch_hash = hashlib.md5("_".join(url_batch).encode()).hexdigest()[:8]
-            batch_num_str = f"batch_{batch_hash}"
-            path_in_repo = f"{batch_num_str}.parquet"
-            api.create_repo(
-                repo_id=repo_id_to_upload,
-                exist_ok=True,
-                repo_type="dataset",
-            )
-            print(
-                f"Uploading {parquet_file} to {repo_id_to_upload} as {path_in_repo}..."
-            )
-
-            api.upload_file(
-                path_or_fileobj=parquet_file,
-                path_in_repo=path_in_repo,
-                repo_id=repo_id_to_upload,
-                repo_type="dataset",
-                commit_message=f"Add batch {batch_num_str} of {pattern_local}",
-                revision="main",
-            )
-
-            # add URL to completed list
-            with open(f"completed/{pattern_local}", "a") as f:
-                for url in url_batch:
-                    f.write(f"{url}\n")
-            print(f"Added {len(url_batch)} URLs to completed list.")
-
-            # Remove everything in the downloads folder
-            for file in downloads_path.glob("**/*.json.gz"):
-                file.unlink(missing_ok=True)
-            # Remove the parquet files
-            for file in downloads_path.glob("**/*.parquet"):
-                file.unlink(missing_ok=True)
-            # Remove URL mapping files
-            for file in downloads_path.glob("url_mapping_*.json"):
-                file.unlink(missing_ok=True)
-            # Remove the intermediate files
-            for file in intermediate_path.glob("*.parquet"):
-                file.unlink(missing_ok=True)
-
-            con.close()
-            print(f"Removed intermediate files for {pattern_local}.")
+                    pending_group += 1
+                    pending_dir = scratch_path / f"pending_{variant.name}_{pending_group}"
+                    pending_dir.mkdir(parents=True, exist_ok=True)
+                    pending_urls = []
+
+            if upload_future is not None:
+                upload_future.result()
+            # The last pending dir was opened but never filled
+            try:
+                pending_dir.rmdir()
+            except OSError:
+                pass
 
 
 if __name__ == "__main__":